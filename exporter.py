@@ -2,16 +2,22 @@
 Cloudflare Prometheus Exporter
 Exports Cloudflare Analytics metrics using GraphQL API to Prometheus
 """
+import asyncio
 import os
+import string
 import time
 import logging
+import threading
 from datetime import datetime, timedelta, timezone
-from pydoc import browse
 
+import httpx
 import requests
 import sentry_sdk
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from prometheus_client import start_http_server, REGISTRY
 from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from prometheus_client.samples import Sample
 
 from state import State
 
@@ -20,6 +26,8 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# httpx logs every request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 if os.environ.get("SENTRY_DSN") :
     sentry_sdk.init(
@@ -29,27 +37,164 @@ if os.environ.get("SENTRY_DSN") :
         send_default_pii=True,
     )
 
+# GraphQL selection for httpRequests1hGroups of a single zone, aliased so several zones fit in one query
+_ANALYTICS_QUERY = string.Template("""
+            ${alias}: zones(filter: {zoneTag: "${zone_tag}"}) {
+              httpRequests1hGroups(
+                filter: {
+                  datetime_geq: "${start}"
+                  datetime_leq: "${end}"
+                }
+                limit: 2
+                orderBy: [datetime_DESC]
+              ) {
+                dimensions{
+                    datetime
+                }
+                sum {
+                  requests
+                  cachedRequests
+                  bytes
+                  cachedBytes
+                  threats
+                  pageViews
+                    browserMap {
+                        pageViews
+                        key: uaBrowserFamily
+                    }
+                    contentTypeMap {
+                        bytes
+                        requests
+                        key: edgeResponseContentTypeName
+                    }
+                    clientSSLMap {
+                        requests
+                        key: clientSSLProtocol
+                    }
+                    countryMap {
+                        bytes
+                        requests
+                        threats
+                        key: clientCountryName
+                    }
+                    ipClassMap {
+                        requests
+                        key: ipType
+                    }
+                    responseStatusMap {
+                        requests
+                        key: edgeResponseStatus
+                    }
+                    threatPathingMap {
+                        requests
+                        key: threatPathingName
+                    }
+                }
+                uniq {
+                  uniques
+                }
+              }""")
+
+# Turnstile challenges issued and solved, appended to the zone selection
+_TURNSTILE_QUERY = string.Template("""
+              issued: firewallEventsAdaptiveByTimeGroups(
+                filter: {
+                  datetime_geq: "${start}"
+                  datetime_leq: "${end}"
+                  OR: [
+                    { action: "jschallenge" }
+                    { action: "managed_challenge" }
+                    { action: "challenge" }
+                  ]
+                }
+                limit: 1
+              ) {
+                count
+              }
+              solved: firewallEventsAdaptiveByTimeGroups(
+                limit: 1
+                filter: {
+                  OR: [
+                    { action: "jschallenge_solved" }
+                    { action: "challenge_solved" }
+                    { action: "managed_challenge_non_interactive_solved" }
+                    { action: "managed_challenge_interactive_solved" }
+                  ]
+                  datetime_geq: "${start}"
+                  datetime_leq: "${end}"
+                }
+              ) {
+                count
+              }""")
+
+_ZONE_QUERY_END = """
+            }"""
+
+def _add_map_samples(family, zone_id, zone_name, label, values):
+    """Append one counter sample per map entry, building the samples directly instead of calling add_metric"""
+    name = family.name + '_total'
+    family.samples.extend(
+        Sample(name, {'zone_id': zone_id, 'zone_name': zone_name, label: str(key)}, value)
+        for key, value in values.items()
+    )
+
+# Retry rate limited and failed API requests with exponential backoff
+_RETRIES = 3
+_RETRY_BACKOFF = 0.3
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
 class CloudflareCollector:
     def __init__(self, api_token, zones=None):
         self.api_token = api_token
         self.zones = zones or []
+        self._zones_filter = frozenset(self.zones)
         self.graphql_url = "https://api.cloudflare.com/client/v4/graphql"
         self.rest_url = "https://api.cloudflare.com/client/v4"
         self.headers = {
             "Authorization": f"Bearer {api_token}",
             "Content-Type": "application/json"
         }
+        # Keep connections to the API alive across requests and retry transient failures
+        self._session = requests.Session()
+        self._session.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(total=_RETRIES, backoff_factor=_RETRY_BACKOFF, status_forcelist=_RETRY_STATUSES)
+        )
+        self._session.mount("https://", adapter)
+        # GraphQL requests are multiplexed as HTTP/2 streams, driven by an event loop owned by the poll thread
+        self._loop = asyncio.new_event_loop()
+        self._aclient = httpx.AsyncClient(
+            headers=self.headers,
+            timeout=30,
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=_RETRIES,
+                limits=httpx.Limits(max_keepalive_connections=20)
+            )
+        )
         self._zone_cache = None
         self._zone_cache_time = 0
         self._zone_cache_ttl = 3600  # Cache zones for 1h
+        self._zone_lock = threading.Lock()
+        self._workers = int(os.getenv("CF_WORKERS", "10"))  # GraphQL requests in flight at once
+        self._max_query_size = 16 * 1024  # Split batched GraphQL queries above 16KB
+        self._turnstile_max_range = timedelta(days=1)  # Longest turnstile window Cloudflare accepts
 
         self._state = State()
 
+        # Cloudflare is polled in the background, scrapes only serve the last result
+        self._poll_interval = int(os.getenv("CF_POLL_INTERVAL", "60"))
+        self._cached_metrics = None
+        self._poll_thread = threading.Thread(target=self._poll_loop, daemon=True)
+        self._poll_thread.start()
+
     def _make_rest_request(self, endpoint):
         """Make REST API request to Cloudflare"""
         try:
             url = f"{self.rest_url}/{endpoint}"
-            response = requests.get(url, headers=self.headers, timeout=30)
+            response = self._session.get(url, timeout=30)
             response.raise_for_status()
             data = response.json()
 
@@ -63,138 +208,161 @@ class CloudflareCollector:
             logger.error(f"Request failed for {endpoint}: {e}")
             return None
 
-    def _make_graphql_request(self, query):
-        """Make GraphQL API request to Cloudflare"""
+    async def _make_graphql_request_async(self, query):
+        """Make GraphQL API request to Cloudflare on the shared HTTP/2 client"""
         try:
-            response = requests.post(
-                self.graphql_url,
-                headers=self.headers,
-                json={"query": query},
-                timeout=30
-            )
+            # httpx only retries connection errors, rate limits and server errors are retried here
+            for attempt in range(_RETRIES + 1):
+                response = await self._aclient.post(self.graphql_url, json={"query": query})
+                if response.status_code not in _RETRY_STATUSES or attempt == _RETRIES:
+                    break
+                logger.warning(f"GraphQL request returned {response.status_code}, retrying")
+                await asyncio.sleep(_RETRY_BACKOFF * 2 ** attempt)
             response.raise_for_status()
-            data = response.json()
-
-            if data['errors'] is not None:
-                logger.error(f"GraphQL errors: {data['errors']}")
-                return None
-
-            return data.get('data').get('viewer').get('zones')[0]
+            return self._get_graphql_viewer(response.json())
         except Exception as e:
             logger.error(f"GraphQL request failed: {e}")
             return None
 
+    def _get_graphql_viewer(self, data):
+        """Get the viewer from a GraphQL response, None if the request failed"""
+        if data.get('errors'):
+            logger.error(f"GraphQL errors: {data['errors']}")
+            # a batched query can still carry data for the zones that did not fail
+            if not data.get('data'):
+                return None
+
+        return (data.get('data') or {}).get('viewer')
+
     def get_zones(self):
         """Get all zones or filter by specified zones (with caching)"""
-        current_time = time.time()
+        with self._zone_lock:
+            current_time = time.time()
 
-        # Return cached zones if still valid
-        if self._zone_cache and (current_time - self._zone_cache_time) < self._zone_cache_ttl:
-            return self._zone_cache
+            # Return cached zones if still valid
+            if self._zone_cache and (current_time - self._zone_cache_time) < self._zone_cache_ttl:
+                return self._zone_cache
 
-        result = self._make_rest_request("zones")
-        if not result:
-            return []
+            result = self._make_rest_request("zones")
+            if not result:
+                return []
 
-        zones = result
-        if self.zones:
-            zones = [z for z in zones if z['name'] in self.zones or z['id'] in self.zones]
+            zones = result
+            if self._zones_filter:
+                zones = [z for z in zones if z['name'] in self._zones_filter or z['id'] in self._zones_filter]
 
-        # Update cache
-        self._zone_cache = zones
-        self._zone_cache_time = current_time
+            # Update cache
+            self._zone_cache = zones
+            self._zone_cache_time = current_time
 
-        return zones
+            return zones
 
-    def get_zone_analytics_graphql(self, zone_tag):
-        """Get analytics for a zone using GraphQL"""
-        # Calculate time range
-        # Ensure we cover up to current hour
-        end_time = datetime.now(timezone.utc) + timedelta(hours=1)
-        # take last few hours, we get only the latest two anyways. We need the previous one as its data can still be updated for some time after the full hour
-        start_time = datetime.now(timezone.utc) - timedelta(hours=3)
+    def _build_zone_query(self, alias, zone_tag, start_str, end_str, turnstile_range=None):
+        """Build the aliased GraphQL selection for a single zone"""
+        query = _ANALYTICS_QUERY.substitute(alias=alias, zone_tag=zone_tag, start=start_str, end=end_str)
+        if turnstile_range is not None:
+            query += _TURNSTILE_QUERY.substitute(start=turnstile_range[0], end=turnstile_range[1])
+        return query + _ZONE_QUERY_END
 
-        # Format times for GraphQL (ISO 8601)
-        start_str = start_time.strftime("%Y-%m-%dT%H:%M:%SZ")
-        end_str = end_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    def _build_batched_query(self, zone_tags, start_str, end_str, turnstile_ranges):
+        """Build GraphQL queries covering all zones, one aliased selection (zone0, zone1, ...) per zone.
 
-        # GraphQL query for httpRequests1hGroups
-        query = f"""
-        {{
-          viewer {{
-            zones(filter: {{zoneTag: "{zone_tag}"}}) {{
-              httpRequests1hGroups(
-                filter: {{
-                  datetime_geq: "{start_str}"
-                  datetime_leq: "{end_str}"
-                }}
-                limit: 2
-                orderBy: [datetime_DESC]
-              ) {{
-                dimensions{{
-                    datetime
-                }}
-                sum {{
-                  requests
-                  cachedRequests
-                  bytes
-                  cachedBytes
-                  threats
-                  pageViews
-                    browserMap {{
-                        pageViews
-                        key: uaBrowserFamily
-                    }}
-                    contentTypeMap {{
-                        bytes
-                        requests
-                        key: edgeResponseContentTypeName
-                    }}
-                    clientSSLMap {{
-                        requests
-                        key: clientSSLProtocol
-                    }}
-                    countryMap {{
-                        bytes
-                        requests
-                        threats
-                        key: clientCountryName
-                    }}
-                    ipClassMap {{
-                        requests
-                        key: ipType
-                    }}
-                    responseStatusMap {{
-                        requests
-                        key: edgeResponseStatus
-                    }}
-                    threatPathingMap {{
-                        requests
-                        key: threatPathingName
-                    }}
-                }}
-                uniq {{
-                  uniques
-                }}
-              }}
-            }}
-          }}
-        }}
+        Returns a list of (aliases, query) chunks, each query stays below the maximum query size.
+        """
+        chunks = []
+        aliases = {}
+        selections = []
+        size = 0
+        for idx, zone_tag in enumerate(zone_tags):
+            alias = f"zone{idx}"
+            selection = self._build_zone_query(alias, zone_tag, start_str, end_str, turnstile_ranges.get(zone_tag))
+            if selections and size + len(selection) > self._max_query_size:
+                chunks.append((aliases, selections))
+                aliases, selections, size = {}, [], 0
+            aliases[alias] = zone_tag
+            selections.append(selection)
+            size += len(selection)
+        if selections:
+            chunks.append((aliases, selections))
+
+        return [(aliases, "{\n  viewer {" + "".join(selections) + "\n  }\n}") for aliases, selections in chunks]
+
+    async def _scrape_all(self, queries):
+        """Run all batched GraphQL queries concurrently. Returns the raw result per zone tag"""
+        semaphore = asyncio.Semaphore(self._workers)
+
+        async def scrape(aliases, query):
+            async with semaphore:
+                return await self._scrape_chunk(aliases, query)
+
+        results = {}
+        for chunk_results in await asyncio.gather(*[scrape(aliases, query) for aliases, query in queries]):
+            results.update(chunk_results)
+        return results
+
+    async def _scrape_chunk(self, aliases, query):
+        """Run one batched GraphQL query. Returns the raw result per zone tag"""
+        result = await self._make_graphql_request_async(query)
+        if result is None:
+            return {}
+
+        ret = {}
+        for alias, zone_tag in aliases.items():
+            zones = result.get(alias) or []
+            if zones:
+                ret[zone_tag] = zones[0]
+        return ret
+
+    def _fetch_zones(self, zones, now, start_str, end_str):
+        """Fetch analytics and turnstile data for all zones using batched GraphQL queries.
+
+        Returns a dict of zone tag -> (analytics, turnstile), zones without a result are left out.
         """
+        now_str = now.strftime("%Y-%m-%dT%H:%M:%SZ")
+        zone_tags = [zone['id'] for zone in zones]
+        turnstile_ranges = {}
+        for zone_tag in zone_tags:
+            turnstile_range = self.get_turnstile_range(zone_tag, now, now_str)
+            if turnstile_range is not None:
+                turnstile_ranges[zone_tag] = turnstile_range
+
+        queries = self._build_batched_query(zone_tags, start_str, end_str, turnstile_ranges)
 
-        result = self._make_graphql_request(query)
+        # Chunks are fetched concurrently
+        results = self._loop.run_until_complete(self._scrape_all(queries))
+
+        # The state lock is only held while aggregating, never during the HTTP requests above
+        ret = {}
+        with self._state.lock:
+            for zone_tag in zone_tags:
+                if zone_tag not in results:
+                    logger.warning(f"No GraphQL result for zone {zone_tag}")
+                    continue
+                result = results[zone_tag]
+                ret[zone_tag] = (self._parse_zone_analytics(zone_tag, result),
+                                 self._parse_turnstile(zone_tag, result, turnstile_ranges.get(zone_tag)))
+        return ret
 
+    def _parse_zone_analytics(self, zone_tag, result):
+        """Update the state with the analytics of a zone and return its counters"""
         groups = result.get('httpRequests1hGroups', [])
 
         if not groups:
             logger.warning(f"No data returned for zone {zone_tag}")
         elif len(groups) < 2:
             logger.warning(f"Less than 2 data points returned for zone {zone_tag}, data may be incomplete")
-            self._state.update(f"httpRequests1hGroupsSums_{zone_tag}", groups[0].get("sum", {}))
+            self._state.update(f"httpRequests1hGroupsSums_{zone_tag}", groups[0].get("sum", {}),
+                               current_hour=groups[0].get("dimensions", {}).get("datetime"))
         else:
             self._state.update(f"httpRequests1hGroupsSums_{zone_tag}", groups[0].get("sum", {}),
-                               groups[1].get("sum", {}))
+                               groups[1].get("sum", {}),
+                               current_hour=groups[0].get("dimensions", {}).get("datetime"),
+                               previous_hour=groups[1].get("dimensions", {}).get("datetime"))
+
+        return self._get_zone_counters(zone_tag)
 
+    def _get_zone_counters(self, zone_tag):
+        """Get the counters of a zone as stored in the state"""
         ret = {
             'requests': self.get_count_from_state(f"httpRequests1hGroupsSums_{zone_tag}", "requests"),
             'cachedRequests': self.get_count_from_state(f"httpRequests1hGroupsSums_{zone_tag}", "cachedRequests"),
@@ -210,62 +378,14 @@ class CloudflareCollector:
 
         return ret
 
-    def get_firewall_events(self, zone_tag):
-        """Get analytics for a zone using GraphQL"""
-        # Calculate time range
-        # Ensure we cover up to current hour
-        end_time = datetime.now(timezone.utc) + timedelta(hours=1)
-        # take last few hours, we get only the latest two anyways. We need the previous one as its data can still be updated for some time after the full hour
-        start_time = datetime.now(timezone.utc) - timedelta(hours=3)
-
-        # Format times for GraphQL (ISO 8601)
-        start_str = start_time.strftime("%Y-%m-%dT%H:%M:%SZ")
-        end_str = end_time.strftime("%Y-%m-%dT%H:%M:%SZ")
-
-        # GraphQL query for httpRequests1hGroups
-        query = f"""
-       {{
-          viewer {{
-            zones(filter: {{zoneTag: "{zone_tag}"}}) {{
-              firewallEventsAdaptive(
-                filter: {{
-                  datetime_geq: "{start_str}"
-                  datetime_leq: "{end_str}"
-                }}
-                limit: 2
-                orderBy: [datetime_DESC]
-              ) {{
-              action
-              clientAsn
-              clientCountryName
-              clientIP
-              clientRequestPath
-              clientRequestQuery
-              datetime
-              source
-              userAgent
-              }}
-            }}
-          }}
-        }}
-        """
-
-        result = self._make_graphql_request(query)
-
-        groups = result.get('httpRequests1hGroups', [])
-
-    def get_turnstile_graphql(self, zone_tag):
-        """Get analytics for a zone using GraphQL"""
+    def get_turnstile_range(self, zone_tag, end_time, end_str):
+        """Get the time range to query turnstile events for, None if the zone is skipped this time"""
         # Always get since last crawl
-        start_str = self._state.get_time("turnstile_last_crawl")
-        end_time = datetime.now(timezone.utc)
-        end_str = end_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        crawl_key = f"turnstile_last_crawl_{zone_tag}"
+        start_str = self._state.get_time(crawl_key)
         if start_str is None:
-            self._state.update_time(f"turnstile_last_crawl", end_str)
-            return {
-                "issued": 0,
-                "solved": 0
-            }
+            self._state.update_time(crawl_key, end_str)
+            return None
 
         start_time = datetime.strptime(start_str, "%Y-%m-%dT%H:%M:%SZ")
         #set time zone
@@ -274,70 +394,42 @@ class CloudflareCollector:
         if seconds_diff < 60:
             # less than 1 minute since last crawl, skip
             logger.info(f"Skipping turnstile crawl for {zone_tag}, only {seconds_diff} seconds since last crawl")
-            return self._state.get_cache("turnstile_last_crawl", {
-                "issued": 0,
-                "solved": 0
-            })
+            return None
 
-        # GraphQL query for httpRequests1hGroups
-        query = f"""
-       {{
-          viewer {{
-            zones(filter: {{zoneTag: "{zone_tag}"}}) {{
-              issued: firewallEventsAdaptiveByTimeGroups(
-                filter: {{
-                  datetime_geq: "{start_str}"
-                  datetime_leq: "{end_str}"
-                  OR: [
-                    {{ action: "jschallenge" }}
-                    {{ action: "managed_challenge" }}
-                    {{ action: "challenge" }}
-                  ]
-                }}
-                limit: 1
-              ) {{
-                count
-              }}
-              solved: firewallEventsAdaptiveByTimeGroups(
-                limit: 1
-                filter: {{
-                  OR: [
-                    {{ action: "jschallenge_solved" }}
-                    {{ action: "challenge_solved" }}
-                    {{ action: "managed_challenge_non_interactive_solved" }}
-                    {{ action: "managed_challenge_interactive_solved" }}
-                  ]
-                  datetime_geq: "{start_str}"
-                  datetime_leq: "{end_str}"
-                }}
-              ) {{
-                count
-              }}
-            }}
-          }}
-        }}
-        """
+        # after failed polls or downtime the window would exceed what Cloudflare allows and fail the whole chunk
+        if end_time - start_time > self._turnstile_max_range:
+            clamped_str = (end_time - self._turnstile_max_range).strftime("%Y-%m-%dT%H:%M:%SZ")
+            logger.info(f"Turnstile crawl for {zone_tag} starts at {clamped_str} instead of last crawl {start_str}")
+            start_str = clamped_str
 
-        result = self._make_graphql_request(query)
+        return start_str, end_str
 
-        self._state.update_time(f"turnstile_last_crawl", end_str)
+    def _parse_turnstile(self, zone_tag, result, turnstile_range):
+        """Get the turnstile counts of a zone from its batched result, or the cached ones if it was skipped"""
+        crawl_key = f"turnstile_last_crawl_{zone_tag}"
+        if turnstile_range is None:
+            return self._state.get_cache(crawl_key, {
+                "issued": 0,
+                "solved": 0
+            })
 
-        if result is None:
+        if result.get('issued') is None or result.get('solved') is None:
+            # failed inside a partial response, keep the last crawl time so the next poll retries this window
+            logger.warning(f"No turnstile data returned for zone {zone_tag}")
             return None
 
+        self._state.update_time(crawl_key, turnstile_range[1])
+
         res = {
-            "issued": result['issued'][0] if len(result['issued']) else 0,
-            "solved": result['solved'][0] if len(result['solved']) else 0
+            "issued": result['issued'][0]['count'] if result['issued'] else 0,
+            "solved": result['solved'][0]['count'] if result['solved'] else 0
         }
-        self._state.set_cache("turnstile_last_crawl", res)
-        logging.debug(f"turnstile_last_crawl: {res}")
+        self._state.set_cache(crawl_key, res)
+        logging.debug(f"{crawl_key}: {res}")
         return res
 
-
     def get_count_from_state(self, group_key, key):
-        if group_key not in self._state.state or key not in self._state.state[group_key]:
-            return 0
-        return self._state.state[group_key][key]["counter"]
+        return self._state.get_counter(group_key, key)
 
     def get_map_count_from_state(self, group_key, item_key, target_key):
         if f"{group_key}_{item_key}" not in self._state.state:
@@ -348,10 +440,19 @@ class CloudflareCollector:
             ret[k] = self.get_count_from_state(f"{group_key}_{item_key}", k)
         return ret
 
-    def collect(self):
+    def _poll_loop(self):
+        """Poll Cloudflare every poll interval, runs in a background thread"""
+        while True:
+            try:
+                self._poll_once()
+            except Exception as e:
+                logger.exception(f"Polling Cloudflare failed: {e}")
+            time.sleep(self._poll_interval)
+
+    def _poll_once(self):
+        """Fetch all metrics from Cloudflare and replace the cached metric families"""
         logger.debug("Starting collection of metrics")
 
-        """Collect metrics for Prometheus"""
         zones = self.get_zones()
 
         if not zones:
@@ -438,17 +539,36 @@ class CloudflareCollector:
         # turnstile solved
         turnstile_solved_total = GaugeMetricFamily(
             'cloudflare_zone_turnstile_solved',
-            'Turnstile solved since last scrape',
+            'Turnstile solved since last poll',
             labels=['zone_id', 'zone_name']
         )
         # turnstile solved
         turnstile_issued_total = GaugeMetricFamily(
             'cloudflare_zone_turnstile_issued',
-            'Turnstile issued since last scrape',
+            'Turnstile issued since last poll',
             labels=['zone_id', 'zone_name']
         )
 
 
+        # Calculate time range once, all zones share the same window
+        now = datetime.now(timezone.utc)
+        # Ensure we cover up to current hour
+        end_time = now + timedelta(hours=1)
+        # take last few hours, we get only the latest two anyways. We need the previous one as its data can still be updated for some time after the full hour
+        start_time = now - timedelta(hours=3)
+
+        # Format times for GraphQL (ISO 8601)
+        start_str = start_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        end_str = end_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        # Get analytics and turnstile via batched GraphQL
+        results = self._fetch_zones(zones, now, start_str, end_str)
+        if not results:
+            # nothing fresh, keep serving the last poll so its timestamp shows the staleness
+            logger.warning("No results from Cloudflare, keeping the metrics of the last poll")
+            self._state.flush()
+            return
+
         for zone in zones:
             zone_id = zone['id']
             zone_name = zone['name']
@@ -458,11 +578,13 @@ class CloudflareCollector:
             # Add zone info
             zone_info.add_metric([zone_id, zone_name, status, plan], 1)
 
-            # Get analytics via GraphQL
-            analytics = self.get_zone_analytics_graphql(zone_id)
-
-            # turnstile
-            turnstile = self.get_turnstile_graphql(zone_id)
+            if zone_id in results:
+                analytics, turnstile = results[zone_id]
+            else:
+                # no fresh data, export the stored counters so they never drop, or nothing if there are none yet
+                stored = f"httpRequests1hGroupsSums_{zone_id}" in self._state.state
+                analytics = self._get_zone_counters(zone_id) if stored else None
+                turnstile = None
 
             if analytics:
                 # Requests
@@ -489,23 +611,14 @@ class CloudflareCollector:
                 uniques = analytics.get('uniques', 0)
                 uniques_total.add_metric([zone_id, zone_name], uniques)
 
-                browsers = analytics.get('browsers', 0)
-                for browser, count in browsers.items():
-                    browsers_total.add_metric([zone_id, zone_name, browser], count)
+                # Browsers
+                _add_map_samples(browsers_total, zone_id, zone_name, 'browser', analytics.get('browsers', {}))
 
                 # Status codes
-                status = analytics.get('status', 0)
-                for status_code, count in status.items():
-                    status_total.add_metric([zone_id, zone_name, str(status_code)], count)
+                _add_map_samples(status_total, zone_id, zone_name, 'status_code', analytics.get('status', {}))
 
                 # Countries
-                countries = analytics.get('countries', 0)
-                for country, count in countries.items():
-                    countries_total.add_metric([zone_id, zone_name, country], count)
-
-            else:
-                # Add zeros if no data available
-                requests_total.add_metric([zone_id, zone_name], 0)
+                _add_map_samples(countries_total, zone_id, zone_name, 'country', analytics.get('countries', {}))
 
             if turnstile:
                 a = turnstile.get("solved", 0.)
@@ -520,19 +633,36 @@ class CloudflareCollector:
                 turnstile_solved_total.add_metric([zone_id, zone_name], 0.)
                 turnstile_issued_total.add_metric([zone_id, zone_name], 0.)
 
-        yield zone_info
-        yield requests_total
-        yield requests_cached
-        yield bandwidth_total
-        yield bandwidth_cached
-        yield threats_total
-        yield pageviews_total
-        yield uniques_total
-        yield browsers_total
-        yield status_total
-        yield countries_total
-        yield turnstile_solved_total
-        yield turnstile_issued_total
+        # Last successful poll, exposes staleness of the cached metrics
+        last_scrape = GaugeMetricFamily(
+            'cloudflare_exporter_last_scrape_timestamp',
+            'Unix timestamp of the last successful Cloudflare poll'
+        )
+        last_scrape.add_metric([], time.time())
+
+        self._state.flush()
+
+        # single reference swap, scrapes see either the old or the new list
+        self._cached_metrics = [
+            zone_info,
+            requests_total,
+            requests_cached,
+            bandwidth_total,
+            bandwidth_cached,
+            threats_total,
+            pageviews_total,
+            uniques_total,
+            browsers_total,
+            status_total,
+            countries_total,
+            turnstile_solved_total,
+            turnstile_issued_total,
+            last_scrape,
+        ]
+
+    def collect(self):
+        """Collect metrics for Prometheus from the last poll"""
+        return iter(self._cached_metrics or [])
 
 
 def main():
@@ -1,6 +1,21 @@
+import hashlib
 import logging
 import os.path
 import json
+import threading
+from collections import deque
+
+try:
+    import orjson
+
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        # same compact output as orjson
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    _loads = json.loads
 
 logging.basicConfig(
     level=os.environ.get("LOG_LEVEL", "INFO"),
@@ -8,21 +23,31 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+STATE_PATH = os.environ.get("STATE_PATH", "/data/state.json")
+
 class State:
     def __init__(self):
-        if os.path.exists("./data/state.json"):
-            with open("./data/state.json", "r") as f:
-                self.state = json.load(f)
+        # all mutations and the flush go through this lock, reentrant so callers can hold it across several updates
+        self.lock = threading.RLock()
+        os.makedirs(os.path.dirname(STATE_PATH) or ".", exist_ok=True)
+        # hash of the last written payload, unchanged state is not written again
+        self._last_hash = None
+        if os.path.exists(STATE_PATH):
+            with open(STATE_PATH, "rb") as f:
+                payload = f.read()
+            self.state = _loads(payload)
+            self._last_hash = hashlib.blake2b(payload, digest_size=16).digest()
         else:
             self.state = {}
+        # counter entries of self.state by (state_key, key), filled on first use
+        self._entries = {}
+        # state is only written on flush, and only if something changed
+        self._dirty = False
 
     def update_time(self, key, time_str):
-        self.state[key] = time_str
-
-        #persist state
-        os.makedirs("/data", exist_ok=True)
-        with open("/data/state.json", "w") as f:
-            json.dump(self.state, f)
+        with self.lock:
+            self.state[key] = time_str
+            self._dirty = True
 
 
     def get_time(self, param):
@@ -32,77 +57,118 @@ class State:
         return self.state.get("cache", {}).get(name, default)
 
     def set_cache(self, name, obj):
-        self.state.get("cachce", {})[name] = obj
-
-    def update(self, state_key, current_hour_values, previous_hour_values=None):
-        self.__update_map(current_hour_values, previous_hour_values, state_key)
-
-        #persist state
-        os.makedirs("/data", exist_ok=True)
-        with open("/data/state.json", "w") as f:
-            json.dump(self.state, f)
+        with self.lock:
+            self.state.setdefault("cache", {})[name] = obj
+            self._dirty = True
+
+    def update(self, state_key, current_hour_values, previous_hour_values=None, current_hour=None, previous_hour=None):
+        # current_hour/previous_hour identify the hours the values belong to (dimensions.datetime of the groups)
+        with self.lock:
+            self.__update_map(current_hour_values, previous_hour_values, state_key, current_hour, previous_hour)
+            self._dirty = True
+
+    def flush(self):
+        with self.lock:
+            if not self._dirty:
+                return
+
+            payload = _dumps(self.state)
+            payload_hash = hashlib.blake2b(payload, digest_size=16).digest()
+            if payload_hash != self._last_hash:
+                #persist state, write to a temp file first so a crash never leaves a partial file
+                tmp = STATE_PATH + ".tmp"
+                with open(tmp, "wb") as f:
+                    f.write(payload)
+                os.replace(tmp, STATE_PATH)
+                self._last_hash = payload_hash
+            self._dirty = False
+
+    def get_counter(self, state_key, k):
+        entry = self._entries.get((state_key, k))
+        if entry is None:
+            entry = self.state.get(state_key, {}).get(k)
+            if entry is None:
+                return 0
+        return entry["counter"]
+
+    def __update_map(self, current_hour_values, previous_hour_values, state_key, current_hour, previous_hour):
+        # walk the nested values with a queue instead of recursing, every leaf is a counter
+        pending = deque([(current_hour_values, previous_hour_values, state_key)])
+        while pending:
+            current_hour_values, previous_hour_values, state_key = pending.popleft()
+
+            if "key" in current_hour_values:
+                key = current_hour_values["key"]
+                for k, v in current_hour_values.items():
+                    if k == "key":
+                        continue
+                    # keys are stored as strings, that is what they are after reloading the state file
+                    current = {str(key): v}
+                    previous = None if previous_hour_values is None else {str(key): previous_hour_values.get(k)}
+                    pending.append((current, previous, state_key+"_"+str(k)))
+                continue
 
-    def __update_map(self, current_hour_values, previous_hour_values, state_key):
+            if state_key not in self.state:
+                self.state[state_key] = {}
 
-        if "key" in current_hour_values:
-            key = current_hour_values["key"]
             for k, v in current_hour_values.items():
-                if k == "key":
+                # if value is a dictionary, walk it as well
+                if isinstance(v, dict):
+                    prev_sub_map = None if previous_hour_values is None else previous_hour_values.get(k)
+                    pending.append((v, prev_sub_map, f"{state_key}/{k}"))
                     continue
-                current = {key: v}
-                previous = None if previous_hour_values is None else {key: previous_hour_values.get(k)}
-                self.__update_map(current, previous, state_key+"_"+str(k))
-            return
-
-        if state_key not in self.state:
-            self.state[state_key] = {}
-
-        for k, v in current_hour_values.items():
-            # if value is a dictionary, recurse
-            if isinstance(v, dict):
-                prev_sub_map = None if previous_hour_values is None else previous_hour_values.get(k)
-                self.__update_map(v, prev_sub_map, f"{state_key}/{k}")
-                continue
-            # if value is a list, recurse as well
-            if isinstance(v, list):
-                if len(v) == 0:
+                # if value is a list, walk every item
+                if isinstance(v, list):
+                    if len(v) == 0:
+                        continue
+                    prev_sub_list = None if previous_hour_values is None else previous_hour_values.get(k)
+                    is_key_value_list = "key" in v[0]
+                    if prev_sub_list is not None and is_key_value_list:
+                        # index the previous hour by key once instead of searching it for every item
+                        prev_by_key = {x["key"]: x for x in prev_sub_list if isinstance(x, dict) and "key" in x}
+                    for idx, item in enumerate(v):
+                        previous_item = None
+                        if prev_sub_list is not None:
+                            if is_key_value_list:
+                                previous_item = prev_by_key.get(item["key"])
+                            elif idx < len(prev_sub_list):
+                                    previous_item = prev_sub_list[idx]
+                        pending.append((item, previous_item, f"{state_key}_{k}"))
                     continue
-                prev_sub_list = None if previous_hour_values is None else previous_hour_values.get(k)
-                is_key_value_list = "key" in v[0]
-                for idx, item in enumerate(v):
-                    previous_item = None
-                    if prev_sub_list is not None:
-                        if is_key_value_list:
-                            previous_item = next((x for x in prev_sub_list if "Key" in x and x["key"] == item["key"]), None)
-                        elif idx < len(prev_sub_list):
-                                previous_item = prev_sub_list[idx]
-                    self.__update_map(item, previous_item, f"{state_key}_{k}")
-                continue
 
-            if k not in self.state[state_key]:
-                self.state[state_key][k] = {"counter": 0, "current_hour_count": 0, "previous_hour_count": 0}
+                self.__increase_counter(k, previous_hour_values, state_key, v, current_hour, previous_hour)
 
-            self.__increase_counter(k, previous_hour_values, state_key, v)
+    def __increase_counter(self, k, previous_hour_values, state_key, v, current_hour, previous_hour):
+        # entries are indexed by (state_key, k), one lookup instead of walking the nested state
+        entry = self._entries.get((state_key, k))
+        if entry is None:
+            entry = self.state[state_key].setdefault(k, {"counter": 0, "current_hour_count": 0, "previous_hour_count": 0})
+            self._entries[(state_key, k)] = entry
 
-    def __increase_counter(self, k, previous_hour_values, state_key, v):
         # get previous value or 0
-        current_hour_count = self.state[state_key][k]["current_hour_count"]
-        previous_hour_count = self.state[state_key][k]["previous_hour_count"]
-
-        # this is when the stat resets due to a new hour
-        if v < current_hour_count:
+        current_hour_count = entry["current_hour_count"]
+        previous_hour_count = entry["previous_hour_count"]
+
+        entry_hour = entry.get("hour")
+        if current_hour is not None and entry_hour is not None:
+            # this is when the stat resets due to a new hour
+            if entry_hour != current_hour:
+                logger.debug("Detected new hour for %s/%s, resetting counters", state_key, k)
+                # what was counted for the entry's hour only carries over if that is now the previous hour
+                previous_hour_count = current_hour_count if entry_hour == previous_hour else 0
+                current_hour_count = 0
+        elif v < current_hour_count:
+            # no hour known, a lower value means a new hour started
             logger.debug("Detected new hour for %s/%s, resetting counters", state_key, k)
             previous_hour_count = current_hour_count
             current_hour_count = 0
 
         # update counters and remember last state
-        previous_hour_value = (0 if previous_hour_values is None else previous_hour_values[k])
+        previous_hour_value = (0 if previous_hour_values is None else previous_hour_values.get(k) or 0)
         logger.debug("Adding to counter for %s/%s: current %d - last %d + previous %d - last previous %d",
                      state_key, k, v, current_hour_count, previous_hour_value, previous_hour_count)
-        self.state[state_key][k]["counter"] += v - current_hour_count
-        self.state[state_key][k]["counter"] += previous_hour_value - previous_hour_count
-        self.state[state_key][k]["current_hour_count"] = v
-        self.state[state_key][k]["previous_hour_count"] = previous_hour_value
-
-
-
+        entry["counter"] += v - current_hour_count + previous_hour_value - previous_hour_count
+        entry["current_hour_count"] = v
+        entry["previous_hour_count"] = previous_hour_value
+        if current_hour is not None:
+            entry["hour"] = current_hour
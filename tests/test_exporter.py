@@ -0,0 +1,218 @@
+import asyncio
+import shutil
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+from prometheus_client.core import CounterMetricFamily
+
+from exporter import CloudflareCollector, _add_map_samples
+from state import State
+
+
+@pytest.fixture(autouse=True)
+def run_around_tests():
+    shutil.rmtree("/data", ignore_errors=True)
+
+
+@pytest.fixture
+def collector():
+    # skip __init__, it starts the poll thread and opens HTTP clients
+    c = CloudflareCollector.__new__(CloudflareCollector)
+    c._max_query_size = 16 * 1024
+    c._turnstile_max_range = timedelta(days=1)
+    c._state = State()
+    return c
+
+
+def test_batched_query_single_chunk(collector):
+    queries = collector._build_batched_query(["a", "b"], "s", "e", {"b": ("ts", "te")})
+
+    assert len(queries) == 1
+    aliases, query = queries[0]
+    assert aliases == {"zone0": "a", "zone1": "b"}
+    assert 'zone0: zones(filter: {zoneTag: "a"})' in query
+    assert 'zone1: zones(filter: {zoneTag: "b"})' in query
+    # turnstile only for the zone with a range
+    assert query.count("issued: firewallEventsAdaptiveByTimeGroups") == 1
+    assert '"ts"' in query and '"te"' in query
+
+
+def test_batched_query_is_chunked_by_size(collector):
+    single = collector._build_zone_query("zone0", "a", "s", "e")
+    collector._max_query_size = 2 * len(single) + 10
+
+    queries = collector._build_batched_query(["a", "b", "c"], "s", "e", {})
+
+    assert [aliases for aliases, _ in queries] == [{"zone0": "a", "zone1": "b"}, {"zone2": "c"}]
+    for _, query in queries:
+        assert query.startswith("{\n  viewer {")
+
+
+def test_scrape_chunk_maps_aliases_to_zones(collector):
+    async def fake_request(query):
+        return {"zone0": [{"httpRequests1hGroups": []}], "zone1": None, "zone2": []}
+
+    collector._make_graphql_request_async = fake_request
+
+    result = asyncio.run(collector._scrape_chunk({"zone0": "a", "zone1": "b", "zone2": "c"}, "query"))
+
+    assert result == {"a": {"httpRequests1hGroups": []}}
+
+
+def test_scrape_chunk_failed_request(collector):
+    async def fake_request(query):
+        return None
+
+    collector._make_graphql_request_async = fake_request
+
+    assert asyncio.run(collector._scrape_chunk({"zone0": "a"}, "query")) == {}
+
+
+def test_turnstile_range_is_clamped(collector):
+    now = datetime(2026, 1, 10, 12, 0, 0, tzinfo=timezone.utc)
+    now_str = now.strftime("%Y-%m-%dT%H:%M:%SZ")
+    collector._state.update_time("turnstile_last_crawl_a", "2026-01-01T00:00:00Z")
+
+    assert collector.get_turnstile_range("a", now, now_str) == ("2026-01-09T12:00:00Z", now_str)
+
+
+def test_graphql_request_retries_rate_limit(collector, monkeypatch):
+    responses = [httpx.Response(429), httpx.Response(200, json={"data": {"viewer": {"zone0": []}}})]
+    collector.graphql_url = "https://api.cloudflare.com/client/v4/graphql"
+    collector._aclient = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: responses.pop(0)))
+
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(asyncio, "sleep", no_sleep)
+
+    assert asyncio.run(collector._make_graphql_request_async("query")) == {"zone0": []}
+    assert responses == []
+
+
+ZONES = [{"id": "a", "name": "a.com", "status": "active", "plan": {"name": "Free"}}]
+
+
+def analytics_group(requests, hour):
+    return {
+        "dimensions": {"datetime": hour},
+        "sum": {"requests": requests, "countryMap": [{"requests": requests, "key": "DE"}]},
+    }
+
+
+@pytest.fixture
+def polling_collector(monkeypatch):
+    monkeypatch.setattr(CloudflareCollector, "_poll_loop", lambda self: None)
+    c = CloudflareCollector("token")
+    # zones are cached so no REST request is made
+    c._zone_cache = ZONES
+    c._zone_cache_time = time.time()
+    return c
+
+
+def mock_graphql(collector, handler):
+    collector._aclient = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def samples(collector):
+    return {(sample.name, tuple(sorted(sample.labels.items()))): sample.value
+            for family in collector.collect() for sample in family.samples}
+
+
+def test_failed_chunk_keeps_counters(polling_collector, monkeypatch):
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(asyncio, "sleep", no_sleep)
+    polling_collector._zone_cache = ZONES + [{"id": "b", "name": "b.com", "status": "active", "plan": {"name": "Free"}}]
+    # one zone per chunk
+    polling_collector._max_query_size = 1
+    groups = [{"httpRequests1hGroups": [analytics_group(10, "2026-01-01T01:00:00Z"),
+                                        analytics_group(5, "2026-01-01T00:00:00Z")]}]
+    mock_graphql(polling_collector, lambda request: httpx.Response(200, json={"data": {"viewer": {
+        "zone0": groups, "zone1": groups
+    }}}))
+    polling_collector._poll_once()
+    before = samples(polling_collector)
+    assert before[("cloudflare_zone_requests_total", (("zone_id", "a"), ("zone_name", "a.com")))] == 15
+
+    # the chunk of zone a fails, zone b still returns data
+    def handler(request):
+        if b"zone0" in request.content:
+            return httpx.Response(503)
+        return httpx.Response(200, json={"data": {"viewer": {"zone1": groups}}})
+
+    mock_graphql(polling_collector, handler)
+    polling_collector._poll_once()
+    after = samples(polling_collector)
+
+    counters = {key: value for key, value in before.items() if key[0].endswith("_total")}
+    assert any(("zone_id", "a") in key[1] for key in counters)
+    for key, value in counters.items():
+        assert after[key] == value
+
+
+def test_collect_serves_last_poll(polling_collector, monkeypatch):
+    assert list(polling_collector.collect()) == []
+
+    mock_graphql(polling_collector, lambda request: httpx.Response(200, json={"data": {"viewer": {
+        "zone0": [{"httpRequests1hGroups": [analytics_group(10, "2026-01-01T01:00:00Z")]}]
+    }}}))
+    monkeypatch.setattr(time, "time", lambda: 1000.0)
+    polling_collector._poll_once()
+
+    families = list(polling_collector.collect())
+    names = [family.name for family in families]
+    assert "cloudflare_zone_requests" in names
+    assert samples(polling_collector)[("cloudflare_exporter_last_scrape_timestamp", ())] == 1000.0
+
+    # every chunk fails, the previous metrics and their timestamp are kept
+    mock_graphql(polling_collector, lambda request: httpx.Response(400))
+    monkeypatch.setattr(time, "time", lambda: 2000.0)
+    polling_collector._poll_once()
+
+    assert list(polling_collector.collect()) == families
+    assert samples(polling_collector)[("cloudflare_exporter_last_scrape_timestamp", ())] == 1000.0
+
+
+def test_graphql_viewer_without_errors_field(collector):
+    assert collector._get_graphql_viewer({"data": {"viewer": {"zone0": []}}}) == {"zone0": []}
+
+
+def test_graphql_viewer_errors_without_data(collector):
+    assert collector._get_graphql_viewer({"data": None, "errors": [{"message": "failed"}]}) is None
+
+
+def test_graphql_viewer_errors_with_partial_data(collector):
+    data = {"data": {"viewer": {"zone0": [], "zone1": None}}, "errors": [{"message": "zone1 failed"}]}
+    assert collector._get_graphql_viewer(data) == {"zone0": [], "zone1": None}
+
+
+def test_turnstile_missing_in_partial_response_is_retried(collector):
+    collector._state.update_time("turnstile_last_crawl_a", "2026-01-01T00:00:00Z")
+
+    result = {"httpRequests1hGroups": [], "issued": None, "solved": [{"count": 2}]}
+    assert collector._parse_turnstile("a", result, ("2026-01-01T00:00:00Z", "2026-01-01T00:05:00Z")) is None
+    assert collector._state.get_time("turnstile_last_crawl_a") == "2026-01-01T00:00:00Z"
+    assert collector._state.get_cache("turnstile_last_crawl_a", None) is None
+
+    result = {"httpRequests1hGroups": [], "issued": [], "solved": [{"count": 2}]}
+    assert collector._parse_turnstile("a", result, ("2026-01-01T00:00:00Z", "2026-01-01T00:05:00Z")) == {
+        "issued": 0, "solved": 2}
+    assert collector._state.get_time("turnstile_last_crawl_a") == "2026-01-01T00:05:00Z"
+
+
+def test_map_samples_match_add_metric():
+    values = {"200": 5, 404: 2}
+    expected = CounterMetricFamily('cloudflare_zone_response_status', 'Status codes',
+                                   labels=['zone_id', 'zone_name', 'status_code'])
+    for status_code, count in values.items():
+        expected.add_metric(["a", "a.com", str(status_code)], count)
+
+    family = CounterMetricFamily('cloudflare_zone_response_status', 'Status codes',
+                                 labels=['zone_id', 'zone_name', 'status_code'])
+    _add_map_samples(family, "a", "a.com", 'status_code', values)
+
+    assert family.samples == expected.samples
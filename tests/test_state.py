@@ -1,9 +1,10 @@
 import json
+import os
 import shutil
 
 import pytest
 
-from state import State  # assuming your class is in state.py
+from state import State, STATE_PATH  # assuming your class is in state.py
 
 
 @pytest.fixture(autouse=True)
@@ -66,4 +67,84 @@ def test_update_previous_empty():
     assert entry["current_hour_count"] == 2
     assert entry["previous_hour_count"] == 6
     # After reset, it should recalc counter without adding weird negatives
-    assert entry["counter"] == 5 + 2 + 1
\ No newline at end of file
+    assert entry["counter"] == 5 + 2 + 1
+
+
+def test_update_is_persisted_on_flush_only():
+    s = State()
+    s.update("serviceA", {"metric1": 5}, {"metric1": 3})
+    assert not os.path.exists(STATE_PATH)
+
+    s.flush()
+    with open(STATE_PATH) as f:
+        assert json.load(f) == s.state
+
+
+def test_flush_skips_unchanged_state():
+    s = State()
+    s.update("serviceA", {"metric1": 5}, {"metric1": 3})
+    s.flush()
+    os.remove(STATE_PATH)
+
+    # same values again, counters do not change
+    s.update("serviceA", {"metric1": 5}, {"metric1": 3})
+    s.flush()
+    assert not os.path.exists(STATE_PATH)
+
+    s.update("serviceA", {"metric1": 6}, {"metric1": 3})
+    s.flush()
+    assert os.path.exists(STATE_PATH)
+
+
+def test_state_is_reloaded_from_file():
+    s = State()
+    s.update("serviceA", {"metric1": 5}, {"metric1": 3})
+    s.flush()
+
+    assert State().state == s.state
+
+
+def test_update_matches_previous_hour_by_key():
+    s = State()
+    current = {"countryMap": [{"requests": 5, "key": "DE"}, {"requests": 2, "key": "US"}]}
+    prev = {"countryMap": [{"requests": 4, "key": "US"}, {"requests": 1, "key": "DE"}, {"requests": 3, "key": "FR"}]}
+    s.update("serviceA", current, prev)
+
+    assert s.state["serviceA_countryMap_requests"]["DE"]["counter"] == 5 + 1
+    assert s.state["serviceA_countryMap_requests"]["US"]["counter"] == 2 + 4
+
+
+def test_cache_survives_reload():
+    s = State()
+    s.set_cache("turnstile", {"issued": 3, "solved": 2})
+    assert s.get_cache("turnstile", None) == {"issued": 3, "solved": 2}
+    s.flush()
+
+    assert State().get_cache("turnstile", None) == {"issued": 3, "solved": 2}
+
+
+def test_int_map_keys_survive_reload():
+    s = State()
+    s.update("serviceA", {"responseStatusMap": [{"requests": 5, "key": 200}]})
+    s.flush()
+
+    s = State()
+    s.update("serviceA", {"responseStatusMap": [{"requests": 7, "key": 200}]})
+
+    assert list(s.state["serviceA_responseStatusMap_requests"].keys()) == ["200"]
+    assert s.state["serviceA_responseStatusMap_requests"]["200"]["counter"] == 7
+
+
+def test_update_detects_new_hour_from_datetime():
+    s = State()
+    s.update("serviceA", {"countryMap": [{"requests": 1, "key": "DE"}]},
+             {"countryMap": [{"requests": 20, "key": "DE"}]}, "2026-01-01T01:00:00Z", "2026-01-01T00:00:00Z")
+    entry = s.state["serviceA_countryMap_requests"]["DE"]
+    assert entry["counter"] == 1 + 20
+
+    # new hour with a count not lower than the last one, value comparison would miss the rollover
+    s.update("serviceA", {"countryMap": [{"requests": 5, "key": "DE"}]},
+             {"countryMap": [{"requests": 3, "key": "DE"}]}, "2026-01-01T02:00:00Z", "2026-01-01T01:00:00Z")
+    assert entry["current_hour_count"] == 5
+    assert entry["previous_hour_count"] == 3
+    assert entry["counter"] == 1 + 20 + 5 + (3 - 1)